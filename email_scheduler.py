@@ -8,47 +8,441 @@ Data: 2024
 
 import smtplib
 import ssl
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email import encoders
+import base64
+import io
+from email import policy
+from email.generator import BytesGenerator
+from email.message import EmailMessage, Message, MIMEPart
 from datetime import datetime, timedelta
-import time
 import schedule
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import atexit
 import json
 import os
-from typing import List, Dict, Optional
+import heapq
+import itertools
+import queue
+from collections import OrderedDict
+import socket
+import threading
+import time
+from typing import Callable, List, Dict, Optional, Tuple
 import argparse
+import copy
+import re
+
+# orjson (opcjonalnie) parsuje i zapisuje JSON kilkukrotnie szybciej niż json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Konfiguracja logowania - rekordy trafiają do kolejki, a zapis do pliku
+# i konsoli odbywa się w osobnym wątku (nie blokuje wysyłki)
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+_log_listener = QueueListener(
+    _log_queue,
+    logging.FileHandler('email_scheduler.log'),
+    logging.StreamHandler(),
+    respect_handler_level=True
+)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
-# Konfiguracja logowania
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('email_scheduler.log'),
-        logging.StreamHandler()
-    ]
+    handlers=[QueueHandler(_log_queue)]
 )
 logger = logging.getLogger(__name__)
 
+# Rozmiar bloku odczytu załącznika - wielokrotność 57 bajtów, więc każdy blok
+# koduje się do pełnych 76-znakowych linii base64 (RFC 2045)
+ATTACHMENT_CHUNK_SIZE = 57 * 1024
+
+
+def _encode_attachment_streaming(path: str, part: Message, chunk: int = ATTACHMENT_CHUNK_SIZE):
+    """
+    Koduje plik do base64 blokami, bez wczytywania całego pliku do pamięci
+    
+    Args:
+        path: Ścieżka do pliku załącznika
+        part: Część MIME, do której trafi zakodowana treść
+        chunk: Rozmiar bloku odczytu w bajtach
+    """
+    encoded = []
+    with open(path, "rb") as attachment:
+        while True:
+            buf = attachment.read(chunk)
+            if not buf:
+                break
+            encoded.append(base64.encodebytes(buf))
+    part.set_payload(b"".join(encoded).decode('ascii'))
+    part['Content-Transfer-Encoding'] = 'base64'
+
+
+# Jeden kontekst SSL dla wszystkich połączeń - magazyn certyfikatów CA
+# wczytywany jest tylko raz
+_SSL_CTX = ssl.create_default_context()
+
+# Polityka wiadomości: linie CRLF (gotowe dla SMTP), treść zawsze 7-bitowa
+# (quoted-printable/base64), bo serwer nie musi obsługiwać 8BITMIME
+SMTP_POLICY = policy.SMTP.clone(cte_type='7bit')
+
+def _read_json(path: str):
+    """Wczytuje plik JSON (orjson jeśli dostępny, w przeciwnym razie json)"""
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_json(path: str, data):
+    """
+    Zapisuje dane do pliku JSON (orjson jeśli dostępny, w przeciwnym razie json)
+    
+    Zapis idzie do pliku tymczasowego, który podmienia oryginał (os.replace) -
+    przerwany zapis nie zostawia uszkodzonego pliku.
+    """
+    if orjson is not None:
+        payload = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    else:
+        payload = json.dumps(data, indent=4, ensure_ascii=False).encode('utf-8')
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# Kropka na początku linii treści musi zostać podwojona (RFC 5321, 4.5.2)
+_LEADING_DOT_RE = re.compile(br'(?m)^\.')
+
+
+def _pipelined_sendmail(server: smtplib.SMTP, from_addr: str, to_addr: str, raw: bytes):
+    """
+    Wysyła gotową wiadomość (bajty, linie CRLF) do jednego odbiorcy
+    
+    Gdy serwer ogłasza PIPELINING (RFC 2920), komendy MAIL FROM, RCPT TO i DATA
+    wysyłane są razem, co oszczędza dwa RTT na wiadomość. W przeciwnym razie
+    używane jest zwykłe SMTP.sendmail. Zgłasza te same wyjątki co sendmail.
+    """
+    server.ehlo_or_helo_if_needed()
+    if not server.has_extn('pipelining'):
+        server.sendmail(from_addr, [to_addr], raw)
+        return
+    
+    size_opt = f" SIZE={len(raw)}" if server.has_extn('size') else ""
+    server.send(
+        f"MAIL FROM:{smtplib.quoteaddr(from_addr)}{size_opt}\r\n"
+        f"RCPT TO:{smtplib.quoteaddr(to_addr)}\r\n"
+        "DATA\r\n"
+    )
+    mail_code, mail_resp = server.getreply()
+    rcpt_code, rcpt_resp = server.getreply()
+    data_code, data_resp = server.getreply()
+    
+    if mail_code != 250 or rcpt_code not in (250, 251):
+        if data_code == 354:
+            # Serwer i tak czeka na treść - zakończ pustą wiadomością
+            server.send(b".\r\n")
+            server.getreply()
+        server.rset()
+        if mail_code != 250:
+            raise smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr)
+        raise smtplib.SMTPRecipientsRefused({to_addr: (rcpt_code, rcpt_resp)})
+    if data_code != 354:
+        server.rset()
+        raise smtplib.SMTPDataError(data_code, data_resp)
+    
+    payload = _LEADING_DOT_RE.sub(b'..', raw)
+    if not payload.endswith(b"\r\n"):
+        payload += b"\r\n"
+    server.send(payload + b".\r\n")
+    code, resp = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
+
+
+# Sparsowane pliki konfiguracyjne: ścieżka -> (st_mtime_ns, konfiguracja)
+_CONFIG_CACHE: Dict[str, Tuple[int, Dict]] = {}
+
+# Zmienne środowiskowe: (nazwa zmiennej, klucz konfiguracji, konwersja wartości)
+_ENV_MAP: List[Tuple[str, str, Callable[[str], object]]] = [
+    ('SMTP_SERVER', 'smtp_server', str),
+    ('SMTP_PORT', 'smtp_port', int),
+    ('SENDER_EMAIL', 'sender_email', str),
+    ('SENDER_PASSWORD', 'sender_password', str),
+    ('SMTP_POOL_SIZE', 'smtp_pool_size', int),
+    ('MAX_MESSAGES_PER_CONNECTION', 'max_messages_per_connection', int),
+    ('USE_TLS', 'use_tls', lambda v: v.lower() in ('true', '1', 'yes')),
+    ('DEFAULT_RECIPIENT', 'recipients', lambda v: [v]),
+    ('DEFAULT_SUBJECT', 'default_subject', str),
+    ('DEFAULT_BODY', 'default_body', str),
+]
+
+# Wysyłka grupowa: maks. liczba emaili w jednej partii i czas zbierania partii (s)
+OUTBOX_MAX_BATCH = 64
+OUTBOX_MAX_WAIT = 0.01
+
+# Maksymalny czas jednego uśpienia schedulera (s) - zabezpieczenie przed zmianą
+# zegara systemowego lub uśpieniem maszyny; poza tym wątki budzą się dokładnie
+# w terminie najbliższego zadania albo po dodaniu nowego
+SCHEDULER_MAX_SLEEP = 3600
+
+# Limit pamięci cache wyrenderowanych wiadomości (bajty)
+RENDER_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Czas życia wpisów w cache DNS serwera SMTP (sekundy)
+DNS_CACHE_TTL = 900
+
+# (host, port) -> (adresy IP w kolejności z getaddrinfo, czas wygaśnięcia wg time.monotonic())
+_DNS_CACHE: Dict[Tuple[str, int], Tuple[List[str], float]] = {}
+
+
+def _resolve_cached(host: str, port: int, ttl: float = DNS_CACHE_TTL) -> List[str]:
+    """
+    Rozwiązuje nazwę hosta SMTP, korzystając z cache w pamięci procesu
+    
+    Args:
+        host: Nazwa hosta serwera SMTP
+        port: Port serwera SMTP
+        ttl: Czas ważności wpisu w sekundach
+        
+    Returns:
+        Adresy IP serwera (bez powtórzeń, w kolejności z getaddrinfo)
+    """
+    now = time.monotonic()
+    hit = _DNS_CACHE.get((host, port))
+    if hit and hit[1] > now:
+        return hit[0]
+    
+    infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    ips = list(dict.fromkeys(info[4][0] for info in infos))
+    _DNS_CACHE[(host, port)] = (ips, now + ttl)
+    return ips
+
+
+class _CachedDNSMixin:
+    """
+    Łączy się z adresami IP z cache DNS; oryginalna nazwa hosta (self._host)
+    nadal jest używana do SNI i weryfikacji certyfikatu
+    """
+    
+    def _get_socket(self, host, port, timeout):
+        # Jak socket.create_connection - próbuj kolejnych adresów (np. IPv4,
+        # gdy IPv6 jest niedostępne), błąd zgłaszany dopiero gdy zawiodą wszystkie
+        last_error = None
+        for ip in _resolve_cached(host, port):
+            try:
+                return super()._get_socket(ip, port, timeout)
+            except OSError as e:
+                last_error = e
+        # Adresy mogły się zmienić - następne połączenie rozwiąże nazwę od nowa
+        _DNS_CACHE.pop((host, port), None)
+        raise last_error
+
+
+class CachedDNSSMTP(_CachedDNSMixin, smtplib.SMTP):
+    """smtplib.SMTP z cache DNS"""
+
+
+class CachedDNSSMTP_SSL(_CachedDNSMixin, smtplib.SMTP_SSL):
+    """smtplib.SMTP_SSL z cache DNS"""
+
+
+class SMTPPool:
+    """Pula zalogowanych połączeń SMTP z limitem wiadomości na połączenie"""
+    
+    def __init__(self, size: int, max_msgs: int, factory: Callable[[], smtplib.SMTP]):
+        """
+        Inicjalizacja puli połączeń
+        
+        Args:
+            size: Maksymalna liczba jednoczesnych połączeń
+            max_msgs: Liczba wiadomości po której połączenie jest odnawiane
+            factory: Funkcja tworząca nowe, zalogowane połączenie SMTP
+        """
+        self.size = size
+        self.max_msgs = max_msgs
+        self.factory = factory
+        
+        # Wolne sloty (połączenie, liczba wysłanych wiadomości);
+        # None oznacza slot bez połączenia - nawiązywane leniwie przy acquire()
+        self._slots: "queue.Queue[Tuple[Optional[smtplib.SMTP], int]]" = queue.Queue(maxsize=size)
+        for _ in range(size):
+            self._slots.put((None, 0))
+    
+    def acquire(self) -> Tuple[smtplib.SMTP, int]:
+        """
+        Pobiera połączenie z puli (blokuje, gdy wszystkie są zajęte)
+        
+        Returns:
+            Krotka (połączenie, liczba wiadomości już przez nie wysłanych)
+        """
+        conn, used = self._slots.get()
+        if conn is not None:
+            try:
+                if conn.noop()[0] == 250:
+                    return conn, used
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._close(conn)
+        
+        try:
+            return self.factory(), 0
+        except BaseException:
+            # Nie trać slotu, jeśli nie udało się połączyć
+            self._slots.put((None, 0))
+            raise
+    
+    def release(self, conn: smtplib.SMTP, used: int):
+        """
+        Zwraca połączenie do puli; po przekroczeniu limitu wiadomości zamyka je
+        
+        Args:
+            conn: Połączenie pobrane przez acquire()
+            used: Łączna liczba wiadomości wysłanych tym połączeniem
+        """
+        if used >= self.max_msgs:
+            # Odnów połączenie zanim serwer sam je zerwie (limity dostawców)
+            self._close(conn)
+            conn, used = None, 0
+        self._slots.put((conn, used))
+    
+    def discard(self, conn: smtplib.SMTP):
+        """Zamyka uszkodzone połączenie i zwalnia jego slot"""
+        self._close(conn)
+        self._slots.put((None, 0))
+    
+    def close(self):
+        """Zamyka wszystkie wolne połączenia w puli"""
+        for _ in range(self.size):
+            try:
+                conn, _used = self._slots.get_nowait()
+            except queue.Empty:
+                break
+            if conn is not None:
+                self._close(conn)
+            self._slots.put((None, 0))
+    
+    @staticmethod
+    def _close(conn: smtplib.SMTP):
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, OSError):
+            # Połączenie mogło zostać już zerwane przez serwer
+            conn.close()
+
+
+class OneShotScheduler:
+    """Jednorazowe zadania w kopcu (heapq) obsługiwane przez jeden wątek"""
+    
+    def __init__(self):
+        """Inicjalizacja kolejki zadań jednorazowych"""
+        # Elementy: (czas uruchomienia jako timestamp, id zadania, funkcja, argumenty)
+        self.heap: List[Tuple[float, int, Callable, tuple]] = []
+        self.cv = threading.Condition()
+        self._ids = itertools.count()
+        self._worker: Optional[threading.Thread] = None
+    
+    def add(self, when: float, fn: Callable, *args) -> int:
+        """
+        Dodaje zadanie do wykonania o określonym czasie
+        
+        Args:
+            when: Czas uruchomienia (timestamp, jak datetime.timestamp())
+            fn: Funkcja do wywołania
+            *args: Argumenty funkcji
+            
+        Returns:
+            Identyfikator zadania
+        """
+        with self.cv:
+            job_id = next(self._ids)
+            heapq.heappush(self.heap, (when, job_id, fn, args))
+            self.cv.notify()
+            
+            # Wątek roboczy startuje przy pierwszym zadaniu
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="email-oneshot", daemon=True)
+                self._worker.start()
+        return job_id
+    
+    def pending(self) -> List[Tuple[float, tuple]]:
+        """Zwraca oczekujące zadania jako (czas uruchomienia, argumenty), od najbliższego"""
+        with self.cv:
+            return [(when, args) for when, _job_id, _fn, args in sorted(self.heap)]
+    
+    def _run(self):
+        """Pętla wątku roboczego - czeka dokładnie do najbliższego terminu"""
+        while True:
+            with self.cv:
+                while True:
+                    if not self.heap:
+                        self.cv.wait()
+                        continue
+                    delay = self.heap[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self.cv.wait(timeout=min(delay, SCHEDULER_MAX_SLEEP))
+                _when, _job_id, fn, args = heapq.heappop(self.heap)
+            
+            try:
+                fn(*args)
+            except Exception as e:
+                logger.error(f"Błąd zadania jednorazowego: {e}")
+
 
 class EmailScheduler:
     """Klasa do zarządzania zaplanowaną wysyłką maili"""
     
-    def __init__(self, config_file: str = "email_config.json"):
+    def __init__(self, config_file: str = "email_config.json", pool_size: Optional[int] = None):
         """
         Inicjalizacja schedulera emaili
         
         Args:
             config_file: Ścieżka do pliku konfiguracyjnego
+            pool_size: Liczba połączeń SMTP w puli (domyślnie z konfiguracji)
         """
         self.config_file = config_file
         self.config = self.load_config()
-        self.smtp_server = None
-        self.smtp_port = None
-        self.sender_email = None
-        self.sender_password = None
+        
+        # Dane serwera i nadawcy nie zmieniają się w trakcie działania - wiąż je raz
+        self.setup_smtp()
+        
+        # Budzi pętlę schedulera, gdy pojawi się nowe zadanie
+        self._wake = threading.Event()
+        
+        # Ustawiane po wysłaniu jednorazowego emaila lub przez stop() - kończy run_scheduler;
+        # _stop_reason trafia do komunikatu SystemExit
+        self._stop = threading.Event()
+        self._stop_reason = ""
+        
+        # Pula trwałych połączeń SMTP współdzielona przez kolejne wysyłki
+        self.pool = SMTPPool(
+            size=pool_size or self.config.get("smtp_pool_size", 1),
+            max_msgs=self.config.get("max_messages_per_connection", 100),
+            factory=self._connect_smtp
+        )
+        
+        # Zadania jednorazowe (konkretna data i godzina)
+        self.oneshot = OneShotScheduler()
+        
+        # Kolejka wymagalnych emaili obsługiwana przez wątki wysyłające
+        # (po jednym na połączenie z puli), które wysyłają je partiami
+        self._outbox: "queue.Queue[tuple]" = queue.Queue()
+        self._outbox_workers: List[threading.Thread] = []
+        self._outbox_lock = threading.Lock()
+        
+        # Wyrenderowane wiadomości (bez nagłówka To) dla identycznych treści,
+        # np. ten sam email do wielu odbiorców - klucz: temat, treść, HTML, załączniki
+        self._render_cache: "OrderedDict[tuple, bytes]" = OrderedDict()
+        self._render_cache_bytes = 0
+        self._render_lock = threading.Lock()
         
     def load_config(self) -> Dict:
         """Ładuje konfigurację ze zmiennych środowiskowych i pliku JSON"""
@@ -56,8 +450,14 @@ class EmailScheduler:
             # Najpierw spróbuj załadować z pliku JSON (dla kompatybilności wstecznej)
             config = {}
             if os.path.exists(self.config_file):
-                with open(self.config_file, 'r', encoding='utf-8') as f:
-                    config = json.load(f)
+                # Parsuj plik tylko gdy zmienił się od ostatniego odczytu
+                mtime = os.stat(self.config_file).st_mtime_ns
+                cached = _CONFIG_CACHE.get(self.config_file)
+                if cached and cached[0] == mtime:
+                    config = copy.deepcopy(cached[1])
+                else:
+                    config = _read_json(self.config_file)
+                    _CONFIG_CACHE[self.config_file] = (mtime, copy.deepcopy(config))
                 logger.info(f"✅ Załadowano konfigurację z {self.config_file}")
             
             # Nadpisz wartościami ze zmiennych środowiskowych (priorytet)
@@ -70,33 +470,14 @@ class EmailScheduler:
     
     def load_from_env(self, config: Dict) -> Dict:
         """Ładuje konfigurację ze zmiennych środowiskowych"""
-        # SMTP settings
-        if os.getenv('SMTP_SERVER'):
-            config['smtp_server'] = os.getenv('SMTP_SERVER')
-        
-        if os.getenv('SMTP_PORT'):
-            try:
-                config['smtp_port'] = int(os.getenv('SMTP_PORT'))
-            except ValueError:
-                pass
-        
-        if os.getenv('SENDER_EMAIL'):
-            config['sender_email'] = os.getenv('SENDER_EMAIL')
-        
-        if os.getenv('SENDER_PASSWORD'):
-            config['sender_password'] = os.getenv('SENDER_PASSWORD')
-        
-        if os.getenv('USE_TLS'):
-            config['use_tls'] = os.getenv('USE_TLS').lower() in ['true', '1', 'yes']
-        
-        if os.getenv('DEFAULT_RECIPIENT'):
-            config['recipients'] = [os.getenv('DEFAULT_RECIPIENT')]
-        
-        if os.getenv('DEFAULT_SUBJECT'):
-            config['default_subject'] = os.getenv('DEFAULT_SUBJECT')
-        
-        if os.getenv('DEFAULT_BODY'):
-            config['default_body'] = os.getenv('DEFAULT_BODY')
+        env = os.environ
+        for env_key, config_key, cast in _ENV_MAP:
+            value = env.get(env_key)
+            if value:
+                try:
+                    config[config_key] = cast(value)
+                except ValueError:
+                    pass
         
         logger.info("✅ Załadowano konfigurację SMTP ze zmiennych środowiskowych")
         return config
@@ -109,6 +490,8 @@ class EmailScheduler:
             "sender_email": "",
             "sender_password": "",
             "use_tls": True,
+            "smtp_pool_size": 1,
+            "max_messages_per_connection": 100,
             "recipients": [],
             "default_subject": "Zaplanowany email",
             "default_body": "To jest zaplanowany email wysłany automatycznie."
@@ -117,24 +500,20 @@ class EmailScheduler:
     def save_config(self):
         """Zapisuje konfigurację do pliku"""
         try:
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(self.config, f, indent=4, ensure_ascii=False)
+            _write_json(self.config_file, self.config)
             logger.info("Konfiguracja została zapisana")
         except Exception as e:
             logger.error(f"Błąd podczas zapisywania konfiguracji: {e}")
     
     def setup_smtp(self):
-        """Konfiguruje połączenie SMTP"""
+        """Konfiguruje połączenie SMTP (wywoływane w __init__ i po zmianie konfiguracji)"""
         self.smtp_server = self.config.get("smtp_server")
         self.smtp_port = self.config.get("smtp_port")
         self.sender_email = self.config.get("sender_email")
         self.sender_password = self.config.get("sender_password")
-        
-        if not self.sender_email or not self.sender_password:
-            raise ValueError("Email nadawcy i hasło muszą być skonfigurowane")
     
     def create_email(self, to_email: str, subject: str, body: str, 
-                    html_body: Optional[str] = None, attachments: Optional[List[str]] = None) -> MIMEMultipart:
+                    html_body: Optional[str] = None, attachments: Optional[List[str]] = None) -> EmailMessage:
         """
         Tworzy wiadomość email
         
@@ -146,40 +525,194 @@ class EmailScheduler:
             attachments: Lista ścieżek do załączników
             
         Returns:
-            Obiekt MIMEMultipart z wiadomością
+            Obiekt EmailMessage z wiadomością
         """
-        msg = MIMEMultipart('alternative')
+        msg = EmailMessage(policy=SMTP_POLICY)
         msg['From'] = self.sender_email
         msg['To'] = to_email
         msg['Subject'] = subject
         
         # Dodaj treść tekstową
-        text_part = MIMEText(body, 'plain', 'utf-8')
-        msg.attach(text_part)
+        msg.set_content(body)
         
         # Dodaj treść HTML jeśli podana
         if html_body:
-            html_part = MIMEText(html_body, 'html', 'utf-8')
-            msg.attach(html_part)
+            msg.add_alternative(html_body, subtype='html')
         
         # Dodaj załączniki
         if attachments:
             for attachment_path in attachments:
                 if os.path.exists(attachment_path):
-                    with open(attachment_path, "rb") as attachment:
-                        part = MIMEBase('application', 'octet-stream')
-                        part.set_payload(attachment.read())
-                        encoders.encode_base64(part)
-                        part.add_header(
-                            'Content-Disposition',
-                            f'attachment; filename= {os.path.basename(attachment_path)}'
-                        )
-                        msg.attach(part)
+                    part = MIMEPart(policy=SMTP_POLICY)
+                    part['Content-Type'] = 'application/octet-stream'
+                    part.add_header(
+                        'Content-Disposition', 'attachment',
+                        filename=os.path.basename(attachment_path)
+                    )
+                    _encode_attachment_streaming(attachment_path, part)
+                    
+                    if msg.get_content_type() != 'multipart/mixed':
+                        msg.make_mixed()
+                    msg.attach(part)
                 else:
                     logger.warning(f"Załącznik {attachment_path} nie istnieje")
         
         return msg
     
+    def _connect_smtp(self) -> smtplib.SMTP:
+        """
+        Nawiązuje nowe, zalogowane połączenie SMTP (fabryka dla puli)
+        
+        Returns:
+            Zalogowany obiekt SMTP/SMTP_SSL
+        """
+        if not self.sender_email or not self.sender_password:
+            raise ValueError("Email nadawcy i hasło muszą być skonfigurowane")
+        
+        # Port 465 wymaga SSL, port 587 wymaga TLS
+        if self.smtp_port == 465:
+            # SSL connection
+            server = CachedDNSSMTP_SSL(self.smtp_server, self.smtp_port, context=_SSL_CTX)
+        else:
+            # TLS connection
+            server = CachedDNSSMTP(self.smtp_server, self.smtp_port)
+            if self.config.get("use_tls", True):
+                server.starttls(context=_SSL_CTX)
+        server.login(self.sender_email, self.sender_password)
+        
+        logger.info(f"🔌 Nawiązano połączenie SMTP z {self.smtp_server}:{self.smtp_port}")
+        return server
+    
+    def _render_email(self, to_email: str, subject: str, body: str,
+                      html_body: Optional[str] = None, attachments: Optional[List[str]] = None) -> bytes:
+        """
+        Zwraca gotową do wysłania wiadomość (bajty, linie CRLF)
+        
+        Treść jest renderowana raz dla danego tematu, treści i załączników;
+        dla kolejnych odbiorców doklejany jest tylko nagłówek To.
+        """
+        # Czas modyfikacji załączników w kluczu - zmieniony plik to nowa wiadomość
+        attachment_key = tuple(
+            (path, os.stat(path).st_mtime_ns if os.path.exists(path) else None)
+            for path in attachments or ()
+        )
+        key = (subject, body, html_body, attachment_key)
+        
+        with self._render_lock:
+            raw = self._render_cache.get(key)
+            if raw is not None:
+                self._render_cache.move_to_end(key)
+        
+        if raw is None:
+            msg = self.create_email(to_email, subject, body, html_body, attachments)
+            del msg['To']
+            
+            # Serializuj bezpośrednio do bajtów (jak SMTP.send_message), bez pośredniego str
+            buf = io.BytesIO()
+            BytesGenerator(buf, policy=msg.policy).flatten(msg)
+            raw = buf.getvalue()
+            
+            if len(raw) <= RENDER_CACHE_MAX_BYTES:
+                with self._render_lock:
+                    if key not in self._render_cache:
+                        self._render_cache[key] = raw
+                        self._render_cache_bytes += len(raw)
+                    while self._render_cache_bytes > RENDER_CACHE_MAX_BYTES:
+                        _key, evicted = self._render_cache.popitem(last=False)
+                        self._render_cache_bytes -= len(evicted)
+        
+        return f"To: {to_email}\r\n".encode('utf-8') + raw
+    
+    def _send_batch(self, items: List[tuple]) -> List[bool]:
+        """
+        Wysyła partię emaili jednym połączeniem z puli
+        
+        Args:
+            items: Lista krotek (to_email, subject, body, html_body, attachments)
+            
+        Returns:
+            Lista wyników (True jeśli email został wysłany) w kolejności items
+        """
+        results = []
+        server, used = None, 0
+        try:
+            for to_email, subject, body, html_body, attachments in items:
+                try:
+                    # Odnów połączenie po osiągnięciu limitu wiadomości
+                    if server is not None and used >= self.pool.max_msgs:
+                        self.pool.release(server, used)
+                        server = None
+                    if server is None:
+                        server, used = self.pool.acquire()
+                    
+                    # Utwórz wiadomość (lub użyj wyrenderowanej wcześniej)
+                    text = self._render_email(to_email, subject, body, html_body, attachments)
+                    
+                    # Wyślij email istniejącym połączeniem
+                    try:
+                        _pipelined_sendmail(server, self.sender_email, to_email, text)
+                    except smtplib.SMTPServerDisconnected:
+                        # Serwer zamknął połączenie w międzyczasie - połącz ponownie i ponów raz
+                        self.pool.discard(server)
+                        server = None
+                        server, used = self.pool.acquire()
+                        _pipelined_sendmail(server, self.sender_email, to_email, text)
+                    used += 1
+                except Exception as e:
+                    logger.error(f"Błąd podczas wysyłania emaila do {to_email}: {e}")
+                    results.append(False)
+                    continue
+                
+                logger.info(f"✅ EMAIL WYSŁANY POMYŚLNIE!")
+                logger.info(f"   📧 Odbiorca: {to_email}")
+                logger.info(f"   📝 Temat: {subject}")
+                logger.info(f"   📄 Treść: {body[:100]}{'...' if len(body) > 100 else ''}")
+                if attachments:
+                    logger.info(f"   📎 Załączniki: {len(attachments)} plików")
+                logger.info(f"   ⏰ Czas wysyłki: {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}")
+                results.append(True)
+        finally:
+            if server is not None:
+                self.pool.release(server, used)
+        
+        return results
+    
+    def _enqueue(self, on_done: Callable[[bool], None], to_email: str, subject: str, body: str,
+                 html_body: Optional[str] = None, attachments: Optional[List[str]] = None):
+        """Dodaje email do kolejki wysyłki; on_done(sukces) zostanie wywołane po próbie wysyłki"""
+        with self._outbox_lock:
+            if not self._outbox_workers:
+                for i in range(self.pool.size):
+                    worker = threading.Thread(target=self._outbox_worker, name=f"email-outbox-{i}", daemon=True)
+                    worker.start()
+                    self._outbox_workers.append(worker)
+        self._outbox.put(((to_email, subject, body, html_body, attachments), on_done))
+    
+    def _outbox_worker(self):
+        """Zbiera emaile z kolejki w partie (maks. OUTBOX_MAX_BATCH / OUTBOX_MAX_WAIT) i wysyła je"""
+        while True:
+            batch = [self._outbox.get()]
+            deadline = time.monotonic() + OUTBOX_MAX_WAIT
+            while len(batch) < OUTBOX_MAX_BATCH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._outbox.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            results = self._send_batch([item for item, _on_done in batch])
+            for (_item, on_done), success in zip(batch, results):
+                try:
+                    on_done(success)
+                except Exception as e:
+                    logger.error(f"Błąd obsługi wyniku wysyłki: {e}")
+    
+    def close_smtp(self):
+        """Zamyka trwałe połączenia SMTP z puli"""
+        self.pool.close()
+    
     def send_email(self, to_email: str, subject: str, body: str, 
                   html_body: Optional[str] = None, attachments: Optional[List[str]] = None) -> bool:
         """
@@ -195,47 +728,7 @@ class EmailScheduler:
         Returns:
             True jeśli email został wysłany pomyślnie
         """
-        try:
-            self.setup_smtp()
-            
-            # Utwórz wiadomość
-            msg = self.create_email(to_email, subject, body, html_body, attachments)
-            
-            # Połącz z serwerem SMTP
-            context = ssl.create_default_context()
-            
-            # Port 465 wymaga SSL, port 587 wymaga TLS
-            if self.smtp_port == 465:
-                # SSL connection
-                with smtplib.SMTP_SSL(self.smtp_server, self.smtp_port, context=context) as server:
-                    server.login(self.sender_email, self.sender_password)
-                    
-                    # Wyślij email
-                    text = msg.as_string()
-                    server.sendmail(self.sender_email, to_email, text)
-            else:
-                # TLS connection
-                with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                    if self.config.get("use_tls", True):
-                        server.starttls(context=context)
-                    server.login(self.sender_email, self.sender_password)
-                    
-                    # Wyślij email
-                    text = msg.as_string()
-                    server.sendmail(self.sender_email, to_email, text)
-                
-            logger.info(f"✅ EMAIL WYSŁANY POMYŚLNIE!")
-            logger.info(f"   📧 Odbiorca: {to_email}")
-            logger.info(f"   📝 Temat: {subject}")
-            logger.info(f"   📄 Treść: {body[:100]}{'...' if len(body) > 100 else ''}")
-            if attachments:
-                logger.info(f"   📎 Załączniki: {len(attachments)} plików")
-            logger.info(f"   ⏰ Czas wysyłki: {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}")
-            return True
-            
-        except Exception as e:
-            logger.error(f"Błąd podczas wysyłania emaila do {to_email}: {e}")
-            return False
+        return self._send_batch([(to_email, subject, body, html_body, attachments)])[0]
     
     def send_scheduled_email(self, to_email: str, subject: str, body: str, 
                            html_body: Optional[str] = None, attachments: Optional[List[str]] = None):
@@ -243,12 +736,14 @@ class EmailScheduler:
         Wysyła zaplanowany email (używane przez scheduler)
         """
         logger.info(f"Wysyłanie zaplanowanego emaila do: {to_email}")
-        success = self.send_email(to_email, subject, body, html_body, attachments)
         
-        if success:
-            logger.info(f"Zaplanowany email do {to_email} został wysłany pomyślnie")
-        else:
-            logger.error(f"Nie udało się wysłać zaplanowanego emaila do {to_email}")
+        def on_done(success: bool):
+            if success:
+                logger.info(f"Zaplanowany email do {to_email} został wysłany pomyślnie")
+            else:
+                logger.error(f"Nie udało się wysłać zaplanowanego emaila do {to_email}")
+        
+        self._enqueue(on_done, to_email, subject, body, html_body, attachments)
     
     def send_scheduled_email_once(self, to_email: str, subject: str, body: str, 
                                html_body: Optional[str] = None, attachments: Optional[List[str]] = None):
@@ -256,19 +751,21 @@ class EmailScheduler:
         Wysyła zaplanowany email JEDNORAZOWO i zatrzymuje scheduler
         """
         logger.info(f"Wysyłanie jednorazowego zaplanowanego emaila do: {to_email}")
-        success = self.send_email(to_email, subject, body, html_body, attachments)
-        
-        if success:
-            logger.info(f"✅ Zaplanowany email do {to_email} został wysłany pomyślnie")
-            logger.info("🛑 Scheduler zostanie zatrzymany po wysłaniu emaila")
-        else:
-            logger.error(f"❌ Nie udało się wysłać zaplanowanego emaila do {to_email}")
         
-        # Usuń wszystkie zadania z tagiem zawierającym ten email
-        schedule.clear(f"once_{to_email}")
+        def on_done(success: bool):
+            if success:
+                logger.info(f"✅ Zaplanowany email do {to_email} został wysłany pomyślnie")
+                logger.info("🛑 Scheduler zostanie zatrzymany po wysłaniu emaila")
+            else:
+                logger.error(f"❌ Nie udało się wysłać zaplanowanego emaila do {to_email}")
+            
+            # Zatrzymaj scheduler - działamy w wątku wysyłającym, więc zamiast
+            # rzucać SystemExit sygnalizujemy pętli run_scheduler
+            self._stop_reason = "Email wysłany"
+            self._stop.set()
+            self._wake.set()
         
-        # Zatrzymaj scheduler poprzez rzucenie wyjątku
-        raise SystemExit("Email wysłany - scheduler zatrzymany")
+        self._enqueue(on_done, to_email, subject, body, html_body, attachments)
     
     def schedule_email(self, to_email: str, subject: str, body: str, 
                       send_time: str, html_body: Optional[str] = None, 
@@ -294,6 +791,7 @@ class EmailScheduler:
                 to_email, subject, body, html_body, attachments
             )
             
+            self._wake.set()
             logger.info(f"Email zaplanowany na {send_time} dla {to_email}")
             
         except ValueError:
@@ -320,31 +818,49 @@ class EmailScheduler:
             logger.error("Data wysyłki musi być w przyszłości")
             return
         
-        # Oblicz opóźnienie w sekundach
-        delay_seconds = (send_datetime - now).total_seconds()
-        
-        # Zaplanuj wysyłkę JEDNORAZOWĄ
-        schedule.every(delay_seconds).seconds.do(
-            self.send_scheduled_email_once, 
+        # Zaplanuj wysyłkę JEDNORAZOWĄ dokładnie na wskazany moment
+        self.oneshot.add(
+            send_datetime.timestamp(),
+            self.send_scheduled_email_once,
             to_email, subject, body, html_body, attachments
-        ).tag(f"once_{to_email}_{send_datetime.timestamp()}")
+        )
         
         logger.info(f"Email zaplanowany na {send_datetime} dla {to_email}")
     
     def run_scheduler(self):
         """Uruchamia scheduler w pętli"""
         logger.info("Scheduler emaili uruchomiony")
+        self._stop.clear()
         try:
-            while True:
+            while not self._stop.is_set():
+                # Śpij dokładnie do najbliższego zadania (bez zadań - do odwołania);
+                # zaplanowanie nowego emaila lub zatrzymanie budzi pętlę wcześniej
+                idle = schedule.idle_seconds()
+                if idle is None or idle > 0:
+                    self._wake.wait(SCHEDULER_MAX_SLEEP if idle is None else min(idle, SCHEDULER_MAX_SLEEP))
+                    self._wake.clear()
                 schedule.run_pending()
-                time.sleep(60)  # Sprawdzaj co minutę
+            
+            raise SystemExit(f"{self._stop_reason} - scheduler zatrzymany")
         except SystemExit as e:
             logger.info(f"🛑 Scheduler zatrzymany: {e}")
             raise
+        finally:
+            self.close_smtp()
+    
+    def stop(self):
+        """Zatrzymuje pętlę run_scheduler bez czekania na kolejne zadanie (bezpieczne z innego wątku)"""
+        self._stop_reason = "Zatrzymanie na żądanie"
+        self._stop.set()
+        self._wake.set()
     
     def get_scheduled_jobs(self):
-        """Zwraca listę zaplanowanych zadań"""
+        """Zwraca listę zaplanowanych zadań cyklicznych"""
         return schedule.get_jobs()
+    
+    def get_oneshot_jobs(self) -> List[Tuple[datetime, tuple]]:
+        """Zwraca listę zaplanowanych emaili jednorazowych jako (data wysyłki, argumenty)"""
+        return [(datetime.fromtimestamp(when), args) for when, args in self.oneshot.pending()]
 
 
 def main():
@@ -355,10 +871,11 @@ def main():
     parser.add_argument("--send-now", help="Wyślij email teraz (format: to_email,subject,body)")
     parser.add_argument("--schedule", help="Zaplanuj email (format: to_email,subject,body,HH:MM)")
     parser.add_argument("--run", action="store_true", help="Uruchom scheduler")
+    parser.add_argument("--pool-size", type=int, help="Liczba równoległych połączeń SMTP w puli")
     
     args = parser.parse_args()
     
-    scheduler = EmailScheduler(args.config)
+    scheduler = EmailScheduler(args.config, pool_size=args.pool_size)
     
     if args.setup:
         # Interaktywna konfiguracja
@@ -374,6 +891,7 @@ def main():
             'sender_email': sender_email,
             'sender_password': sender_password
         })
+        scheduler.setup_smtp()
         
         scheduler.save_config()
         print("Konfiguracja zapisana!")
@@ -383,7 +901,11 @@ def main():
         parts = args.send_now.split(',', 2)
         if len(parts) >= 3:
             to_email, subject, body = parts
-            success = scheduler.send_email(to_email.strip(), subject.strip(), body.strip())
+            try:
+                success = scheduler.send_email(to_email.strip(), subject.strip(), body.strip())
+            finally:
+                # Połączenie z puli wraca do niej po wysyłce - zamknij je (QUIT) przed wyjściem
+                scheduler.close_smtp()
             print(f"Email {'wysłany' if success else 'nie został wysłany'}")
         else:
             print("Nieprawidłowy format. Użyj: to_email,subject,body")
@@ -6,18 +6,19 @@ Skrypt do uruchamiania Telegram Bota z zmiennymi środowiskowymi
 
 import os
 import sys
+from pathlib import Path
 from telegram_bot import EmailPlanningBot
 
 def load_env_file():
     """Ładuje zmienne środowiskowe z pliku .env"""
     env_file = '.env'
     if os.path.exists(env_file):
-        with open(env_file, 'r') as f:
-            for line in f:
-                line = line.strip()
-                if line and not line.startswith('#') and '=' in line:
-                    key, value = line.split('=', 1)
-                    os.environ[key] = value
+        text = Path(env_file).read_text(encoding='utf-8')
+        pairs = [
+            line.split('=', 1) for line in text.splitlines()
+            if line.strip() and not line.lstrip().startswith('#') and '=' in line
+        ]
+        os.environ.update({key.strip(): value.strip() for key, value in pairs})
         print("✅ Załadowano zmienne środowiskowe z .env")
     else:
         print("⚠️ Plik .env nie istnieje. Używam zmiennych systemowych.")
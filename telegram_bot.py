@@ -6,40 +6,234 @@ Bot analizuje wiadomości tekstowe i głosowe, planuje emaile
 """
 
 import os
-import json
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import atexit
 import asyncio
+import functools
+import hashlib
+import io
+import queue
+import re
+import signal
+import threading
+import time
+from collections import deque
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
-from typing import Dict, List, Optional, Tuple
-import tempfile
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 
 # Telegram Bot API
 from telegram import Update, Bot
+from telegram.constants import ChatAction
+from telegram.request import HTTPXRequest
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
 # OpenAI API
 import openai
+import httpx
+
+# Cache odpowiedzi AI
+from cachetools import Cache, LRUCache, TTLCache
+
+# Lokalna transkrypcja krótkich wiadomości głosowych (opcjonalnie)
+try:
+    from faster_whisper import WhisperModel
+except ImportError:
+    WhisperModel = None
+
+# Szybsza pętla zdarzeń oparta na libuv (opcjonalnie, tylko Linux/macOS)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# Ponawianie zapytań przy limitach OpenAI
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 
 # Nasz system emaili
-from email_scheduler import EmailScheduler
-
-# Konfiguracja logowania
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('telegram_bot.log'),
-        logging.StreamHandler()
-    ]
-)
+from email_scheduler import EmailScheduler, _read_json, _write_json
+
+# Konfiguracja logowania - główny logger (konsola, kolejka) ustawia już email_scheduler
+# przy imporcie, więc basicConfig byłby tu pominięty. Logi bota trafiają dodatkowo
+# przez kolejkę do telegram_bot.log - zapis na dysk w osobnym wątku, nie w pętli zdarzeń
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+_log_listener = QueueListener(_log_queue, logging.FileHandler('telegram_bot.log'))
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+_log_handler = QueueHandler(_log_queue)
+_log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 logger = logging.getLogger(__name__)
+logger.addHandler(_log_handler)
+
+# Mikro-batching zapytań do OpenAI: maks. liczba zapytań w partii i czas jej zbierania (s)
+OPENAI_BATCH_MAX = 8
+OPENAI_BATCH_WAIT = 0.05
+
+# Zapytania odrzucone przez OpenAI z powodu limitu (429) lub przeciążenia (5xx)
+# oraz zerwane połączenia i przekroczone limity czasu (APITimeoutError dziedziczy
+# po APIConnectionError) są ponawiane z losowym wykładniczym opóźnieniem (1-30 s, maks. 5 prób). Czekanie
+# odbywa się poza semaforem, więc nie zajmuje miejsca innym zapytaniom
+_openai_retry = retry(
+    wait=wait_random_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    retry=retry_if_exception_type((openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)),
+    reraise=True
+)
+
+# Wiadomości głosowe do LOCAL_WHISPER_MAX_DURATION s transkrybowane są lokalnie
+# (faster-whisper, model "tiny" skwantyzowany do int8) - bez zapytania do OpenAI
+LOCAL_WHISPER_MAX_DURATION = 10
+LOCAL_WHISPER_MODEL = "tiny"
+# Maks. liczba równoległych transkrypcji lokalnych (inferencja obciąża CPU)
+LOCAL_WHISPER_CONCURRENCY = 2
+
+# Konwersacje nieaktywne dłużej niż CONVERSATION_TTL s są usuwane z pamięci
+# przez zadanie JobQueue uruchamiane co CONVERSATION_PRUNE_INTERVAL s
+CONVERSATION_TTL = 24 * 3600
+CONVERSATION_PRUNE_INTERVAL = 600
+
+# Zmiany adresów email użytkowników zapisywane są na dysk zbiorczo, najwyżej raz
+# na USER_EMAILS_FLUSH_INTERVAL s
+USER_EMAILS_FLUSH_INTERVAL = 1
+
+# Co ile sekund odświeżać "pisze..." (Telegram wygasza akcję po ok. 5 s)
+TYPING_INTERVAL = 4
+
+# Cache odpowiedzi AI: maks. liczba wpisów i czas życia wpisu (s)
+AI_CACHE_SIZE = 4096
+AI_CACHE_TTL = 600
+
+# Wiadomości z czasem względnym ("za 2 godziny", "jutro") nie trafiają do cache -
+# ta sama wiadomość po kilku minutach oznacza inną datę wysyłki
+_RELATIVE_TIME_RE = re.compile(r"\b(za|jutro|dzi[sś]|dzisiaj|pojutrze|teraz|minut\w*|godzin\w*)\b")
+
+# Formaty czasu wysyłki: "za X minut/godzin/dni", "DD.MM.RRRR HH:MM" i "HH:MM".
+# Format względny to tylko prefiks - dalszy tekst ("za 30 minut.", "za 2 godziny rano")
+# jest pomijany; formaty bezwzględne muszą obejmować cały napis
+_TIME_RE = re.compile(
+    r"^(?:za\s+(?P<amount>\d+)\s+(?P<unit>minut|godzin|dni)\w*\b"
+    r"|(?P<day>\d{1,2})\.(?P<month>\d{1,2})\.(?P<year>\d{4})\s+(?P<hour>\d{1,2}):(?P<minute>\d{2})$"
+    r"|(?P<hour2>\d{1,2}):(?P<minute2>\d{2})$)"
+)
+# Rdzeń jednostki -> argument timedelta
+_UNIT_MAP = {"minut": "minutes", "godzin": "hours", "dni": "days"}
+
+# Jedyny typ aktualizacji, który bot obsługuje - Telegram filtruje pozostałe po swojej
+# stronie, więc nie są przesyłane ani dekodowane (Update.de_json)
+_ALLOWED_UPDATES = [Update.MESSAGE]
+
+# Filtr wiadomości tekstowych (bez komend) - budowany raz
+_TEXT_FILTER = filters.TEXT & ~filters.COMMAND
+
+# Walidacja adresu email w /set: coś@domena.tld, bez spacji i drugiego "@"
+_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+\Z")
+
+# Odpowiedzi komend /status i /set - stały tekst, per wywołanie wstawiane są tylko dane
+# (/status jako zwykły tekst - pogrubienie znakami Unicode, bez parse_mode)
+_STATUS_TEMPLATE = """📊 𝐒𝐭𝐚𝐭𝐮𝐬 𝐛𝐨𝐭𝐚
+
+✅ Bot aktywny
+✅ Email scheduler: {recipient}
+✅ OpenAI API: {openai}
+✅ Aktywne konwersacje: {conversations}
+
+𝐎𝐬𝐭𝐚𝐭𝐧𝐢𝐞 𝐚𝐤𝐭𝐲𝐰𝐧𝐨ś𝐜𝐢:
+Sprawdź logi w pliku telegram_bot.log"""
+
+_SET_OK_TEMPLATE = (
+    "✅ **Email ustawiony!**\n\n"
+    "Twój adres email to: `{email}`\n\n"
+    "Teraz wszystkie zaplanowane emaile będą wysyłane na ten adres! 📧"
+)
+
+_SET_BAD = (
+    "❌ **Nieprawidłowy format emaila!**\n\n"
+    "Użyj: `/set twoj@email.com`\n"
+    "Przykład: `/set jan.kowalski@gmail.com`"
+)
+
+_SET_SHOW_TEMPLATE = (
+    "📧 **Twój aktualny email:** `{email}`\n\n"
+    "**Aby zmienić email, użyj:**\n"
+    "`/set nowy@email.com`\n\n"
+    "**Przykład:**\n"
+    "`/set jan.kowalski@gmail.com`"
+)
+
+# Metoda formatująca związana z szablonem raz, przy imporcie
+_format_status = _STATUS_TEMPLATE.format_map
+
+
+@functools.lru_cache(maxsize=128)
+def _render_status(recipient: str, openai_state: str, conversations: int) -> str:
+    """Zwraca gotową treść /status (zmienia się tylko liczba konwersacji, więc trafienia są częste)"""
+    return _format_status({"recipient": recipient, "openai": openai_state, "conversations": conversations})
+
+
+class _EvictingLRUCache(LRUCache):
+    """LRUCache, który zgłasza wpisy usunięte z powodu limitu rozmiaru"""
+    
+    def __init__(self, maxsize: int, on_evict: Callable[[Any, Any], None]):
+        """
+        Args:
+            maxsize: Maksymalna liczba wpisów
+            on_evict: Wywoływana z (klucz, wartość) dla każdego wypartego wpisu
+        """
+        super().__init__(maxsize=maxsize)
+        self._on_evict = on_evict
+    
+    def popitem(self):
+        key, value = super().popitem()
+        self._on_evict(key, value)
+        return key, value
+
+
+class ConversationState:
+    """Pamięć konwersacji jednego użytkownika (__slots__ - bez __dict__ na każdy wpis)"""
+    
+    __slots__ = ("messages", "current_email_plan", "waiting_for", "last_seen")
+    
+    def __init__(self, max_history: int):
+        """
+        Inicjalizacja stanu konwersacji
+        
+        Args:
+            max_history: Maksymalna liczba wiadomości w historii
+        """
+        # Historia ograniczona do max_history - najstarsze wypadają same
+        self.messages: deque = deque(maxlen=max_history)
+        self.current_email_plan: Dict = {}
+        self.waiting_for: Optional[str] = None  # Co bot czeka od użytkownika
+        self.last_seen = time.monotonic()
 
 
 class EmailPlanningBot:
     """Bot Telegram do planowania wysyłki emaili z AI"""
     
+    # Prompt systemowy - stały tekst budowany raz, per zapytanie wstawiane są tylko email i czas
+    SYSTEM_PROMPT_TEMPLATE = """Jestes pomocnym botem do planowania wysylki emaili. 
+
+INSTRUKCJE:
+1. Analizuj wiadomosci uzytkownikow i wyciagaj informacje o planowanym emailu
+2. Zawsze wysylaj emaile na adres: {user_email}
+3. Sam decyduj jaki ma byc temat i tresc emaila na podstawie widoamosci od uzytkownika.
+4. Daty podawaj w formacie: DD.MM.RRRR HH:MM lub "za X minut/godzin/dni"
+5. Daty wzgledne (np. "jutro", "za godzine") przeliczaj wzgledem aktualnej daty i godziny podanej ponizej
+6. Pamiętaj, ze Twoim glownym zadaniem jest planowanie wysylki emaili.
+
+AKTUALNE INFORMACJE:
+- Aktualna data i godzina: {current_time}
+- Email użytkownika, na który będą wysyłane emaile: {user_email}
+
+FORMAT ODPOWIEDZI:
+- Jesli masz wszystkie dane: "GOTOWE: temat|tresc|data_wysylki"
+
+Przyklad kompletnych danych:
+GOTOWE: Przypomnienie o spotkaniu|Spotkanie za 15 minut w sali konferencyjnej|za 2 godziny"""
+    
     def __init__(self, config_file: str = "bot_config.json"):
         """
         Inicjalizacja bota
@@ -50,18 +244,67 @@ class EmailPlanningBot:
         self.config_file = config_file
         self.config = self.load_config()
         
+        # Wartości z konfiguracji używane przy każdym /status - ustalane raz
+        self._has_openai_str = 'Połączone' if self.config.get('openai_api_key') else 'Nie skonfigurowane'
+        self._default_recipient = self.config.get('default_recipient', 'borysm32@gmail.com')
+        
         # Inicjalizacja komponentów
         self.email_scheduler = EmailScheduler("email_config.json")
-        self.openai_client = openai.OpenAI(api_key=self.config.get("openai_api_key"))
+        # Asynchroniczny klient - zapytania do OpenAI nie blokują pętli zdarzeń bota.
+        # HTTP/2 multipleksuje wiele równoległych zapytań w jednym połączeniu TLS,
+        # a keep-alive utrzymuje połączenia między kolejnymi partiami zapytań
+        self.openai_client = openai.AsyncOpenAI(
+            api_key=self.config.get("openai_api_key"),
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=128, max_keepalive_connections=64),
+                http2=True
+            ),
+            # Ponawianie obsługuje _openai_retry - bez podwójnych prób w kliencie
+            max_retries=0
+        )
+        
+        # Kolejka zapytań chat.completions i limit równoległych zapytań do OpenAI
+        # (wspólny dla czatu i transkrypcji; tworzone przy pierwszym zapytaniu,
+        # już wewnątrz pętli zdarzeń)
+        self._req_queue: Optional[asyncio.Queue] = None
+        self._req_worker: Optional[asyncio.Task] = None
+        self._openai_sem: Optional[asyncio.Semaphore] = None
+        # Referencje do partii w toku - pętla zdarzeń trzyma zadania tylko słabo
+        self._batch_tasks: set = set()
+        
+        # Lokalny model Whisper (ładowany raz, pod blokadą, przy pierwszej krótkiej
+        # wiadomości głosowej) i limit równoległych transkrypcji lokalnych
+        self._local_whisper = None
+        self._local_whisper_lock = threading.Lock()
+        self._local_whisper_sem: Optional[asyncio.Semaphore] = None
+        
+        # Folder attachments tworzony raz, przy pierwszym załączniku
+        self._attachments_dir_created = False
+        
+        # Zadanie z pętlą schedulera emaili (jedno na cały bot)
+        self._scheduler_task: Optional[asyncio.Task] = None
+        
+        # Cache odpowiedzi AI - klucz (user_id, skrót historii konwersacji i znormalizowanej wiadomości)
+        self._ai_cache = TTLCache(maxsize=AI_CACHE_SIZE, ttl=AI_CACHE_TTL)
         
         # Pamięć konwersacji - przechowuje kontekst dla każdego użytkownika
-        self.conversation_memory: Dict[int, Dict] = {}
+        # (ograniczona - najdawniej aktywni użytkownicy są usuwani)
+        max_users = self.config.get("max_users_in_memory", 10000)
+        self.conversation_memory: Dict[int, ConversationState] = _EvictingLRUCache(
+            max_users, lambda _user_id, _memory: self._count_conversation(-1)
+        )
+        # Licznik aktywnych konwersacji dla /status - zmieniany przy tworzeniu,
+        # wyparciu z LRU i czyszczeniu nieaktywnych
+        self._active_convs = 0
         
         # Stan planowania emaila dla każdego użytkownika
-        self.email_planning_state: Dict[int, Dict] = {}
+        self.email_planning_state: Dict[int, Dict] = LRUCache(maxsize=max_users)
         
         # Email adresy użytkowników - każdy użytkownik ma swój  email
-        self.user_emails: Dict[int, str] = {}
+        # (zwykły słownik - to dane użytkownika, nie można ich usuwać; trwale w pliku JSON)
+        self.user_emails_file = self.config.get("user_emails_file", "user_emails.json")
+        self.user_emails: Dict[int, str] = self.load_user_emails()
+        self._user_emails_dirty = False
         
         logger.info("Bot EmailPlanningBot zainicjalizowany")
     
@@ -71,16 +314,12 @@ class EmailPlanningBot:
             # Najpierw spróbuj załadować z pliku JSON (dla kompatybilności wstecznej)
             config = {}
             if os.path.exists(self.config_file):
-                with open(self.config_file, 'r', encoding='utf-8') as f:
-                    config = json.load(f)
+                config = _read_json(self.config_file)
                 logger.info(f"✅ Załadowano konfigurację z {self.config_file}")
             
             # Nadpisz wartościami ze zmiennych środowiskowych (priorytet)
             config = self.load_from_env(config)
             
-            # Konwertuj wszystkie wartości string na UTF-8
-            config = self.ensure_utf8_config(config)
-            
             return config
         except Exception as e:
             logger.error(f"❌ Błąd ładowania konfiguracji: {e}")
@@ -116,6 +355,18 @@ class EmailPlanningBot:
             except ValueError:
                 pass
         
+        if os.getenv('OPENAI_CONCURRENCY'):
+            try:
+                config['openai_concurrency'] = int(os.getenv('OPENAI_CONCURRENCY'))
+            except ValueError:
+                pass
+        
+        if os.getenv('MAX_USERS_IN_MEMORY'):
+            try:
+                config['max_users_in_memory'] = int(os.getenv('MAX_USERS_IN_MEMORY'))
+            except ValueError:
+                pass
+        
         if os.getenv('MAX_CONVERSATION_HISTORY'):
             try:
                 config['max_conversation_history'] = int(os.getenv('MAX_CONVERSATION_HISTORY'))
@@ -125,20 +376,6 @@ class EmailPlanningBot:
         logger.info("✅ Załadowano konfigurację ze zmiennych środowiskowych")
         return config
     
-    def ensure_utf8_config(self, config: Dict) -> Dict:
-        """Zapewnia poprawne kodowanie UTF-8 dla konfiguracji"""
-        def convert_to_utf8(obj):
-            if isinstance(obj, str):
-                return obj.encode('utf-8').decode('utf-8')
-            elif isinstance(obj, dict):
-                return {k: convert_to_utf8(v) for k, v in obj.items()}
-            elif isinstance(obj, list):
-                return [convert_to_utf8(item) for item in obj]
-            else:
-                return obj
-        
-        return convert_to_utf8(config)
-    
     def get_default_config(self) -> Dict:
         """Zwraca domyślną konfigurację"""
         return {
@@ -152,31 +389,62 @@ class EmailPlanningBot:
     def save_config(self):
         """Zapisuje konfigurację"""
         try:
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(self.config, f, indent=4, ensure_ascii=False)
+            _write_json(self.config_file, self.config)
             logger.info("Konfiguracja bota zapisana")
         except Exception as e:
             logger.error(f"Błąd podczas zapisywania konfiguracji: {e}")
     
-    def get_user_memory(self, user_id: int) -> Dict:
+    def get_user_memory(self, user_id: int) -> "ConversationState":
         """Pobiera pamięć konwersacji użytkownika"""
         if user_id not in self.conversation_memory:
-            self.conversation_memory[user_id] = {
-                "messages": [],
-                "current_email_plan": {},
-                "waiting_for": None  # Co bot czeka od użytkownika
-            }
+            self.conversation_memory[user_id] = ConversationState(self.config.get("max_conversation_history", 10))
+            self._count_conversation(1)
         return self.conversation_memory[user_id]
     
+    def _count_conversation(self, delta: int):
+        """Aktualizuje licznik aktywnych konwersacji"""
+        self._active_convs += delta
+    
     def get_user_email(self, user_id: int) -> str:
         """Pobiera email użytkownika lub zwraca domyślny"""
-        return self.user_emails.get(user_id, self.config.get("default_recipient", "borysm32@gmail.com"))
+        return self.user_emails.get(user_id, self._default_recipient)
     
     def set_user_email(self, user_id: int, email: str):
-        """Ustawia email użytkownika"""
+        """Ustawia email użytkownika (zapis na dysk w tle - _user_emails_writer)"""
         self.user_emails[user_id] = email
+        self._user_emails_dirty = True
         logger.info(f"✅ Użytkownik {user_id} ustawił email: {email}")
     
+    def load_user_emails(self) -> Dict[int, str]:
+        """Wczytuje zapisane adresy email użytkowników"""
+        if not os.path.exists(self.user_emails_file):
+            return {}
+        try:
+            # Klucze JSON są stringami - przywróć int (user_id z Telegrama)
+            return {int(user_id): email for user_id, email in _read_json(self.user_emails_file).items()}
+        except Exception as e:
+            logger.error(f"❌ Błąd ładowania adresów użytkowników: {e}")
+            return {}
+    
+    async def _flush_user_emails(self):
+        """Zapisuje adresy email użytkowników, jeśli zmieniły się od ostatniego zapisu"""
+        if not self._user_emails_dirty:
+            return
+        # Kopia robiona w pętli zdarzeń - wątek zapisujący nie widzi późniejszych zmian
+        snapshot = {str(user_id): email for user_id, email in self.user_emails.items()}
+        self._user_emails_dirty = False
+        try:
+            await asyncio.to_thread(_write_json, self.user_emails_file, snapshot)
+        except Exception as e:
+            self._user_emails_dirty = True
+            logger.error(f"❌ Błąd zapisu adresów użytkowników: {e}")
+    
+    async def _user_emails_writer(self):
+        """Co USER_EMAILS_FLUSH_INTERVAL s zapisuje zmienione adresy - kilka /set łączy się w jeden zapis"""
+        while True:
+            await asyncio.sleep(USER_EMAILS_FLUSH_INTERVAL)
+            await self._flush_user_emails()
+    
     def get_actual_datetime(self) -> str:
         """Zwraca aktualną datę i godzinę w formacie czytelnym dla AI"""
         now = datetime.now(ZoneInfo("Europe/Warsaw"))
@@ -188,65 +456,161 @@ class EmailPlanningBot:
             content = ""
         
         memory = self.get_user_memory(user_id)
-        memory["messages"].append({"role": role, "content": content})
-        
-        # Ogranicz historię konwersacji
-        max_history = self.config.get("max_conversation_history", 10)
-        if len(memory["messages"]) > max_history:
-            memory["messages"] = memory["messages"][-max_history:]
+        memory.messages.append({"role": role, "content": content})
+        memory.last_seen = time.monotonic()
+    
+    async def _prune_conversations(self, context: ContextTypes.DEFAULT_TYPE):
+        """Zadanie JobQueue - usuwa konwersacje i stany planowania nieaktywne dłużej niż CONVERSATION_TTL"""
+        cutoff = time.monotonic() - CONVERSATION_TTL
+        # Cache.__getitem__ czyta wpis bez oznaczania go jako ostatnio użyty -
+        # items() przez LRUCache.__getitem__ zresetowałoby kolejność wypierania
+        peek = functools.partial(Cache.__getitem__, self.conversation_memory)
+        stale = [user_id for user_id in list(self.conversation_memory) if peek(user_id).last_seen < cutoff]
+        for user_id in stale:
+            del self.conversation_memory[user_id]
+            self.email_planning_state.pop(user_id, None)
+        self._count_conversation(-len(stale))
+        if stale:
+            logger.info(f"🧹 Usunięto {len(stale)} nieaktywnych konwersacji")
     
     def get_conversation_context(self, user_id: int) -> List[Dict]:
         """Zwraca kontekst konwersacji dla OpenAI"""
         memory = self.get_user_memory(user_id)
         
-        # Pobierz email użytkownika
+        # Pobierz email użytkownika i aktualny czas - oba znane lokalnie,
+        # więc podajemy je od razu zamiast przez wywołanie funkcji przez AI
         user_email = self.get_user_email(user_id)
+        current_time = self.get_actual_datetime()
         
         # Podstawowe instrukcje
         context = [
             {
                 "role": "system",
-                "content": f"""Jestes pomocnym botem do planowania wysylki emaili. 
-
-INSTRUKCJE:
-1. Analizuj wiadomosci uzytkownikow i wyciagaj informacje o planowanym emailu
-2. Zawsze wysylaj emaile na adres: {user_email}
-3. Sam decyduj jaki ma byc temat i tresc emaila na podstawie widoamosci od uzytkownika.
-4. Daty podawaj w formacie: DD.MM.RRRR HH:MM lub "za X minut/godzin/dni"
-5. Przed ustaleniem daty wysylki emaila zawsze wywołaj funkcję get_actual_datetime() aby uzyskać aktualną datę i godzinę
-6. Pamiętaj, ze Twoim glownym zadaniem jest planowanie wysylki emaili.
-
-DOSTĘPNE FUNKCJE:
-- get_actual_datetime(): Zwraca aktualną datę i godzinę w formacie DD.MM.RRRR HH:MM
-- get_user_email(): Zwraca aktualny email użytkownika na który będą wysyłane emaile
-
-Użyj tych funkcji gdy potrzebujesz aktualnych informacji!
-
-FORMAT ODPOWIEDZI:
-- Jesli masz wszystkie dane: "GOTOWE: temat|tresc|data_wysylki"
-
-Przyklad kompletnych danych:
-GOTOWE: Przypomnienie o spotkaniu|Spotkanie za 15 minut w sali konferencyjnej|za 2 godziny"""
+                "content": self.SYSTEM_PROMPT_TEMPLATE.format(
+                    user_email=user_email,
+                    current_time=current_time
+                )
             }
         ]
         
         # Dodaj historię konwersacji
-        context.extend(memory["messages"])
+        context.extend(memory.messages)
         return context
     
-    async def transcribe_voice(self, voice_file_path: str) -> str:
-        """Transkrybuje plik głosowy na tekst"""
+    def _transcribe_local(self, audio_data: bytes) -> str:
+        """Transkrybuje nagranie lokalnym modelem faster-whisper (blokujące - wywoływać w wątku)"""
+        if self._local_whisper is None:
+            with self._local_whisper_lock:
+                # Inny wątek mógł załadować model, gdy ten czekał na blokadę
+                if self._local_whisper is None:
+                    self._local_whisper = WhisperModel(LOCAL_WHISPER_MODEL, device="cpu", compute_type="int8")
+        segments, _info = self._local_whisper.transcribe(io.BytesIO(audio_data), language="pl")
+        return "".join(segment.text for segment in segments).strip()
+    
+    async def transcribe_voice(self, audio_data: bytes, duration: Optional[int] = None) -> str:
+        """
+        Transkrybuje nagranie głosowe (OGG z Telegrama) na tekst
+        
+        Args:
+            audio_data: Zawartość nagrania
+            duration: Długość nagrania w sekundach (krótkie nagrania - lokalny model, jeśli dostępny)
+            
+        Returns:
+            Transkrypcja lub pusty string przy błędzie
+        """
+        if WhisperModel is not None and duration is not None and duration <= LOCAL_WHISPER_MAX_DURATION:
+            if self._local_whisper_sem is None:
+                self._local_whisper_sem = asyncio.Semaphore(LOCAL_WHISPER_CONCURRENCY)
+            try:
+                # Czekanie na semafor w pętli zdarzeń - nie zajmuje wątków executora
+                async with self._local_whisper_sem:
+                    text = await asyncio.to_thread(self._transcribe_local, audio_data)
+                if text:
+                    return text
+            except Exception as e:
+                logger.warning(f"⚠️ Lokalna transkrypcja nieudana, używam OpenAI Whisper: {e}")
+        
         try:
-            with open(voice_file_path, "rb") as audio_file:
-                transcript = self.openai_client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio_file
-                )
+            transcript = await self._create_transcription(audio_data)
             return transcript.text
         except Exception as e:
             logger.error(f"Błąd transkrypcji głosu: {e}")
             return ""
     
+    async def _submit(self, **request) -> Any:
+        """
+        Kolejkuje zapytanie chat.completions i czeka na jego wynik
+        
+        Args:
+            **request: Argumenty dla openai_client.chat.completions.create
+            
+        Returns:
+            Odpowiedź OpenAI
+        """
+        if self._req_worker is None or self._req_worker.done():
+            if self._req_queue is None:
+                self._req_queue = asyncio.Queue()
+            self._req_worker = asyncio.create_task(self._completion_worker())
+        
+        future = asyncio.get_running_loop().create_future()
+        await self._req_queue.put((request, future))
+        return await future
+    
+    async def _completion_worker(self):
+        """Zbiera zapytania w partie (maks. OPENAI_BATCH_MAX / OPENAI_BATCH_WAIT) i wysyła je równolegle"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._req_queue.get()]
+            deadline = loop.time() + OPENAI_BATCH_WAIT
+            while len(batch) < OPENAI_BATCH_MAX:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._req_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Partia leci w tle - kolejne zapytania nie czekają na jej zakończenie
+            task = asyncio.create_task(self._run_batch(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+    
+    async def _run_batch(self, batch: List[Tuple[Dict, asyncio.Future]]):
+        """Wysyła partię zapytań równolegle i przekazuje wyniki oczekującym"""
+        results = await asyncio.gather(
+            *(self._create_completion(request) for request, _future in batch),
+            return_exceptions=True
+        )
+        for (_request, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+    
+    def _get_openai_sem(self) -> asyncio.Semaphore:
+        """Zwraca semafor ograniczający liczbę równoległych zapytań do OpenAI"""
+        if self._openai_sem is None:
+            self._openai_sem = asyncio.Semaphore(self.config.get("openai_concurrency", 20))
+        return self._openai_sem
+    
+    @_openai_retry
+    async def _create_completion(self, request: Dict) -> Any:
+        """Pojedyncze zapytanie chat.completions ograniczone semaforem"""
+        async with self._get_openai_sem():
+            return await self.openai_client.chat.completions.create(**request)
+    
+    @_openai_retry
+    async def _create_transcription(self, audio_data: bytes) -> Any:
+        """Pojedyncze zapytanie do Whisper ograniczone semaforem"""
+        async with self._get_openai_sem():
+            return await self.openai_client.audio.transcriptions.create(
+                model="whisper-1",
+                file=("voice.ogg", audio_data)
+            )
+    
     async def analyze_message_with_ai(self, user_id: int, message_text: str) -> str:
         """Analizuje wiadomość użytkownika za pomocą AI"""
         try:
@@ -254,6 +618,22 @@ GOTOWE: Przypomnienie o spotkaniu|Spotkanie za 15 minut w sali konferencyjnej|za
             if not message_text or message_text.strip() == "":
                 return "Nie otrzymalem zadnej wiadomosci. Napisz cos lub nagraj wiadomosc glosowa."
             
+            # Identyczna wiadomość po identycznej historii w ciągu AI_CACHE_TTL - odpowiedź
+            # bez zapytania do OpenAI (odpowiedź zależy od historii, np. "tak" po różnych pytaniach)
+            normalized = message_text.strip().lower()
+            cache_key = None
+            if not _RELATIVE_TIME_RE.search(normalized):
+                digest = hashlib.blake2b(digest_size=16)
+                for msg in self.get_user_memory(user_id).messages:
+                    digest.update(f"{msg['role']}\0{msg['content']}\0".encode())
+                digest.update(normalized.encode())
+                cache_key = (user_id, digest.digest())
+                cached = self._ai_cache.get(cache_key)
+                if cached is not None:
+                    self.add_to_memory(user_id, "user", message_text)
+                    self.add_to_memory(user_id, "assistant", cached)
+                    return cached
+            
             # Dodaj wiadomość użytkownika do pamięci
             self.add_to_memory(user_id, "user", message_text)
             
@@ -269,67 +649,17 @@ GOTOWE: Przypomnienie o spotkaniu|Spotkanie za 15 minut w sali konferencyjnej|za
             if not clean_context:
                 return "Nie moge przetworzyc tej wiadomosci. Sprobuj ponownie."
             
-            # Definicja funkcji dostępnych dla AI
-            functions = [
-                {
-                    "name": "get_actual_datetime",
-                    "description": "Pobiera aktualną datę i godzinę w formacie DD.MM.RRRR HH:MM. Użyj gdy użytkownik mówi o datach względnych jak 'jutro', 'za godzinę', 'za 2 dni'",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {},
-                        "required": []
-                    }
-                },
-                {
-                    "name": "get_user_email",
-                    "description": "Pobiera aktualny email użytkownika na który będą wysyłane emaile",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {},
-                        "required": []
-                    }
-                }
-            ]
-            
-            # Wyślij do OpenAI z funkcjami
-            response = self.openai_client.chat.completions.create(
+            # Wyślij do OpenAI - data i email są już w kontekście, więc wystarcza jedno zapytanie
+            response = await self._submit(
                 model=self.config.get("openai_model", "gpt-3.5-turbo"),
-                messages=clean_context,
-                functions=functions,
-                function_call="auto"
+                messages=clean_context
             )
             
-            # Sprawdź czy AI chce wywołać funkcję
-            message = response.choices[0].message
-            if message.function_call:
-                function_name = message.function_call.name
-                if function_name == "get_actual_datetime":
-                    # Wywołaj funkcję i dodaj wynik do kontekstu
-                    current_time = self.get_actual_datetime()
-                    clean_context.append({
-                        "role": "function",
-                        "name": "get_actual_datetime",
-                        "content": f"Aktualna data i godzina: {current_time}"
-                    })
-                    
-                elif function_name == "get_user_email":
-                    # Wywołaj funkcję i dodaj wynik do kontekstu
-                    user_email = self.get_user_email(user_id)
-                    clean_context.append({
-                        "role": "function",
-                        "name": "get_user_email",
-                        "content": f"Aktualny email użytkownika: {user_email}"
-                    })
-                
-                # Wyślij ponownie do AI z wynikami funkcji
-                response = self.openai_client.chat.completions.create(
-                    model=self.config.get("openai_model", "gpt-3.5-turbo"),
-                    messages=clean_context
-                )
-            
             ai_response = response.choices[0].message.content
             if ai_response:
                 self.add_to_memory(user_id, "assistant", ai_response)
+                if cache_key is not None:
+                    self._ai_cache[cache_key] = ai_response
                 return ai_response
             else:
                 return "Nie otrzymalem odpowiedzi od AI. Sprobuj ponownie."
@@ -374,67 +704,61 @@ GOTOWE: Przypomnienie o spotkaniu|Spotkanie za 15 minut w sali konferencyjnej|za
     
     def parse_send_time(self, time_str: str) -> datetime:
         """Parsuje czas wysyłki w różnych formatach"""
-        time_str = time_str.strip().lower()
         now = datetime.now()
+        match = _TIME_RE.match(time_str.strip().lower())
         
-        try:
-            # Format: "za X minut/godzin/dni"
-            if time_str.startswith("za "):
-                parts = time_str.split()
-                if len(parts) >= 3:
-                    amount = int(parts[1])
-                    unit = parts[2]
-                    
-                    if "minut" in unit:
-                        return now + timedelta(minutes=amount)
-                    elif "godzin" in unit:
-                        return now + timedelta(hours=amount)
-                    elif "dni" in unit:
-                        return now + timedelta(days=amount)
-            
-            # Format: "DD.MM.RRRR HH:MM"
-            elif "." in time_str and ":" in time_str:
-                date_part, time_part = time_str.split()
-                day, month, year = map(int, date_part.split("."))
-                hour, minute = map(int, time_part.split(":"))
-                return datetime(year, month, day, hour, minute)
-            
-            # Format: "HH:MM" (dzisiaj)
-            elif len(time_str) == 5 and ":" in time_str:
-                hour, minute = map(int, time_str.split(":"))
-                target_time = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if match is not None:
+            try:
+                # Format: "za X minut/godzin/dni"
+                if match["amount"]:
+                    return now + timedelta(**{_UNIT_MAP[match["unit"]]: int(match["amount"])})
+                
+                # Format: "DD.MM.RRRR HH:MM"
+                if match["day"]:
+                    return datetime(int(match["year"]), int(match["month"]), int(match["day"]),
+                                    int(match["hour"]), int(match["minute"]))
+                
+                # Format: "HH:MM" (dzisiaj)
+                target_time = now.replace(hour=int(match["hour2"]), minute=int(match["minute2"]),
+                                          second=0, microsecond=0)
                 if target_time <= now:
                     target_time += timedelta(days=1)
                 return target_time
-            
-        except (ValueError, IndexError):
-            pass
+            except ValueError:
+                # Np. 31.02 albo 25:00 - poprawny format, niepoprawna data
+                pass
         
         # Domyślnie za godzinę
         return now + timedelta(hours=1)
     
-    async def start_scheduler_background(self):
-        """Uruchamia scheduler w tle"""
+    def _run_scheduler_blocking(self):
+        """Pętla schedulera emaili (blokująca - uruchamiana w wątku przez asyncio.to_thread)"""
+        logger.info("🚀 Uruchamianie schedulera w tle...")
         try:
-            import threading
-            import time
-            
-            def run_scheduler():
-                logger.info("🚀 Uruchamianie schedulera w tle...")
-                try:
-                    self.email_scheduler.run_scheduler()
-                except SystemExit:
-                    logger.info("✅ Scheduler zakończony po wysłaniu emaila")
-                except Exception as e:
-                    logger.error(f"❌ Błąd schedulera: {e}")
-            
-            # Uruchom scheduler w osobnym wątku
-            scheduler_thread = threading.Thread(target=run_scheduler, daemon=True)
-            scheduler_thread.start()
-            logger.info("✅ Scheduler uruchomiony w tle")
-            
+            self.email_scheduler.run_scheduler()
+        except SystemExit as e:
+            # SystemExit przepuszczony do zadania asyncio zatrzymałby całą pętlę bota
+            logger.info(f"✅ Scheduler zakończony: {e}")
         except Exception as e:
-            logger.error(f"❌ Błąd uruchamiania schedulera: {e}")
+            logger.error(f"❌ Błąd schedulera: {e}")
+    
+    async def start_scheduler_background(self):
+        """Uruchamia scheduler w tle (jedno zadanie - ponownie tylko gdy poprzednie się zakończyło)"""
+        if self._scheduler_task is not None and not self._scheduler_task.done():
+            return
+        self._scheduler_task = asyncio.create_task(asyncio.to_thread(self._run_scheduler_blocking))
+        logger.info("✅ Scheduler uruchomiony w tle")
+    
+    async def stop_scheduler_background(self):
+        """Zatrzymuje pętlę schedulera emaili i czeka na zakończenie jej wątku"""
+        task = self._scheduler_task
+        if task is None:
+            return
+        # stop() ponawiany, bo wątek mógł jeszcze nie wejść do run_scheduler,
+        # które na starcie czyści flagę zatrzymania
+        while not task.done():
+            self.email_scheduler.stop()
+            await asyncio.wait({task}, timeout=0.1)
     
     async def schedule_email_from_ai(self, user_id: int, email_data: Dict, attachment_path: Optional[str] = None):
         """Planuje email na podstawie danych z AI"""
@@ -444,16 +768,6 @@ GOTOWE: Przypomnienie o spotkaniu|Spotkanie za 15 minut w sali konferencyjnej|za
             # Pobierz email użytkownika
             user_email = self.get_user_email(user_id)
             
-            # Log szczegółów emaila przed planowaniem
-            logger.info(f"📧 PLANOWANIE EMAILA:")
-            logger.info(f"   👤 Użytkownik: {user_id}")
-            logger.info(f"   📧 Odbiorca: {user_email}")
-            logger.info(f"   📝 Temat: {email_data['subject']}")
-            logger.info(f"   📅 Data wysyłki: {send_datetime.strftime('%d.%m.%Y %H:%M')}")
-            logger.info(f"   📄 Treść: {email_data['body'][:200]}{'...' if len(email_data['body']) > 200 else ''}")
-            if attachment_path:
-                logger.info(f"   📎 Załącznik: {attachment_path}")
-            
             # Zaplanuj email
             self.email_scheduler.schedule_email_datetime(
                 to_email=user_email,
@@ -463,11 +777,13 @@ GOTOWE: Przypomnienie o spotkaniu|Spotkanie za 15 minut w sali konferencyjnej|za
                 attachments=[attachment_path] if attachment_path else None
             )
             
-            # Log potwierdzenia planowania
-            logger.info(f"✅ EMAIL ZAPLANOWANY POMYŚLNIE!")
-            logger.info(f"   📧 Temat: {email_data['subject']}")
-            logger.info(f"   📅 Wysyłka: {send_datetime.strftime('%d.%m.%Y %H:%M')}")
-            logger.info(f"   👤 Użytkownik: {user_id}")
+            # Jeden rekord z potwierdzeniem planowania
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    f"✅ Email zaplanowany: użytkownik={user_id} odbiorca={user_email} "
+                    f"temat={email_data['subject']!r} wysyłka={send_datetime.strftime('%d.%m.%Y %H:%M')}"
+                    + (f" załącznik={attachment_path}" if attachment_path else "")
+                )
             
             # Uruchom scheduler w tle
             await self.start_scheduler_background()
@@ -479,185 +795,181 @@ GOTOWE: Przypomnienie o spotkaniu|Spotkanie za 15 minut w sali konferencyjnej|za
             return f"✅ Email zaplanowany pomyślnie!\n\n📧 Temat: {email_data['subject']}\n📧 Odbiorca: {user_email}\n📅 Data wysyłki: {send_datetime.strftime('%d.%m.%Y %H:%M')}\n📝 Treść: {email_data['body'][:100]}{'...' if len(email_data['body']) > 100 else ''}"
             
         except Exception as e:
-            logger.error(f"❌ BŁĄD PLANOWANIA EMAILA:")
-            logger.error(f"   👤 Użytkownik: {user_id}")
-            logger.error(f"   📧 Temat: {email_data.get('subject', 'BRAK')}")
-            logger.error(f"   ⚠️  Błąd: {e}")
+            logger.error(f"❌ Błąd planowania emaila: użytkownik={user_id} temat={email_data.get('subject', 'BRAK')!r} błąd={e}")
             return f"❌ Błąd podczas planowania emaila: {e}"
     
-    async def handle_text_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Obsługuje wiadomości tekstowe"""
-        user_id = update.effective_user.id
-        message_text = update.message.text
-        
-        logger.info(f"Wiadomosc tekstowa od {user_id}: {message_text}")
+    async def _keep_typing(self, update: Update):
+        """Wysyła akcję "pisze..." co TYPING_INTERVAL s, aż zadanie zostanie anulowane"""
+        while True:
+            try:
+                await update.effective_chat.send_action(ChatAction.TYPING)
+            except Exception as e:
+                # Akcja jest tylko kosmetyczna - błąd nie może przerwać obsługi wiadomości
+                logger.debug(f"Nie udało się wysłać akcji typing: {e}")
+                return
+            await asyncio.sleep(TYPING_INTERVAL)
+    
+    async def _handle_nl_message(self, user_id: int, text: str, update: Update, source_tag: str = ""):
+        """
+        Analizuje wiadomość (tekst lub transkrypcję) przez AI i wykonuje zwróconą akcję
         
-        # Sprawdź czy wiadomość nie jest pusta
-        if not message_text or message_text.strip() == "":
-            await update.message.reply_text("Nie otrzymalem zadnej wiadomosci. Napisz cos lub nagraj wiadomosc glosowa.")
+        Args:
+            user_id: ID użytkownika Telegram
+            text: Treść wiadomości
+            update: Aktualizacja Telegram, na którą odpowiadamy
+            source_tag: Dopisek w logach, np. " (GŁOS)"
+        """
+        msg = update.effective_message
+        # Posty kanałów nie mają nadawcy (effective_user) - bot obsługuje tylko użytkowników
+        if msg is None or update.effective_user is None:
             return
         
-        # Analizuj wiadomość za pomocą AI
-        ai_response = await self.analyze_message_with_ai(user_id, message_text)
+        # Analizuj wiadomość za pomocą AI - w tym czasie użytkownik widzi "pisze..."
+        typing_task = asyncio.create_task(self._keep_typing(update))
+        try:
+            ai_response = await self.analyze_message_with_ai(user_id, text)
+        finally:
+            typing_task.cancel()
         
         # Parsuj odpowiedź AI
         action_type, data = self.parse_ai_response(ai_response)
+        log_info = logger.isEnabledFor(logging.INFO)
+        
+        # Ostatnia sparsowana odpowiedź trafia do stanu planowania - handle_document
+        # korzysta z niej zamiast szukać i ponownie parsować wiadomość z historii
+        state = self.email_planning_state.get(user_id)
+        if state is not None:
+            state["_parsed"] = (action_type, data)
         
         if action_type == "schedule_email":
             # AI ma wszystkie dane - zaplanuj email
-            logger.info(f"🤖 AI zdecydował: PLANOWANIE EMAILA")
-            logger.info(f"   👤 Użytkownik: {user_id}")
-            logger.info(f"   📝 Temat: {data.get('subject', 'BRAK')}")
-            logger.info(f"   📅 Czas: {data.get('send_time', 'BRAK')}")
+            if log_info:
+                logger.info(f"🤖 AI zdecydował{source_tag}: PLANOWANIE EMAILA - użytkownik={user_id} "
+                            f"temat={data.get('subject', 'BRAK')!r} czas={data.get('send_time', 'BRAK')!r}")
             
             result_message = await self.schedule_email_from_ai(user_id, data)
-            await update.message.reply_text(result_message)
+            await msg.reply_text(result_message)
             
         elif action_type == "request_attachment":
             # AI potrzebuje załącznika
-            logger.info(f"🤖 AI zdecydował: PROŚBA O ZAŁĄCZNIK")
-            logger.info(f"   👤 Użytkownik: {user_id}")
-            logger.info(f"   📎 Info: {data.get('info', 'BRAK')}")
+            if log_info:
+                logger.info(f"🤖 AI zdecydował{source_tag}: PROŚBA O ZAŁĄCZNIK - użytkownik={user_id} "
+                            f"info={data.get('info', 'BRAK')!r}")
             
-            self.email_planning_state[user_id] = data
-            await update.message.reply_text(f"📎 {data['info']}\n\nWyslij zalacznik jako plik.")
+            self.email_planning_state[user_id] = {**data, "_parsed": (action_type, data)}
+            await msg.reply_text(f"📎 {data['info']}\n\nWyslij zalacznik jako plik.")
             
         else:
             # Zwykła odpowiedź tekstowa
-            logger.info(f"🤖 AI zdecydował: ODPOWIEDŹ TEKSTOWA")
-            logger.info(f"   👤 Użytkownik: {user_id}")
-            logger.info(f"   💬 Odpowiedź: {ai_response[:100]}{'...' if len(ai_response) > 100 else ''}")
+            if log_info:
+                logger.info(f"🤖 AI zdecydował{source_tag}: ODPOWIEDŹ TEKSTOWA - użytkownik={user_id} "
+                            f"odpowiedź={ai_response[:100]!r}")
             
-            await update.message.reply_text(ai_response)
+            await msg.reply_text(ai_response)
+    
+    async def handle_text_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Obsługuje wiadomości tekstowe"""
+        msg = update.effective_message
+        if msg is None or update.effective_user is None:
+            return
+        
+        user_id = update.effective_user.id
+        message_text = msg.text
+        
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f"Wiadomosc tekstowa od {user_id}: {message_text}")
+        
+        # Sprawdź czy wiadomość nie jest pusta
+        if not message_text or message_text.strip() == "":
+            await msg.reply_text("Nie otrzymalem zadnej wiadomosci. Napisz cos lub nagraj wiadomosc glosowa.")
+            return
+        
+        await self._handle_nl_message(user_id, message_text, update)
     
     async def handle_voice_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Obsługuje wiadomości głosowe"""
+        msg = update.effective_message
+        if msg is None or update.effective_user is None:
+            return
+        
         user_id = update.effective_user.id
         
         logger.info(f"Wiadomość głosowa od {user_id}")
         
         try:
             # Pobierz plik głosowy
-            voice = update.message.voice
+            voice = msg.voice
             file = await context.bot.get_file(voice.file_id)
             
-            # Zapisz do pliku tymczasowego
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".ogg") as temp_file:
-                await file.download_to_drive(temp_file.name)
-                temp_file_path = temp_file.name
-            
-            # Transkrybuj na tekst
-            transcribed_text = await self.transcribe_voice(temp_file_path)
-            
-            # Usuń plik tymczasowy
-            os.unlink(temp_file_path)
+            # Pobierz nagranie do pamięci i transkrybuj na tekst (bez pliku tymczasowego)
+            audio_data = await file.download_as_bytearray()
+            transcribed_text = await self.transcribe_voice(bytes(audio_data), voice.duration)
             
             if transcribed_text and transcribed_text.strip():
-                await update.message.reply_text(f"🎤 Transkrypcja: {transcribed_text}")
+                await msg.reply_text(f"🎤 Transkrypcja: {transcribed_text}")
                 
-                # Przetwórz transkrypcję bezpośrednio
-                await self.process_transcribed_message(user_id, transcribed_text, update, context)
+                # Przetwórz transkrypcję tak jak wiadomość tekstową
+                logger.info(f"Przetwarzanie transkrypcji od {user_id}: {transcribed_text}")
+                await self._handle_nl_message(user_id, transcribed_text, update, " (GŁOS)")
             else:
-                await update.message.reply_text("❌ Nie udalo sie przetworzyc wiadomosci glosowej.")
+                await msg.reply_text("❌ Nie udalo sie przetworzyc wiadomosci glosowej.")
                 
         except Exception as e:
             logger.error(f"Błąd przetwarzania wiadomości głosowej: {e}")
-            await update.message.reply_text("❌ Błąd podczas przetwarzania wiadomości głosowej.")
-    
-    async def process_transcribed_message(self, user_id: int, transcribed_text: str, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Przetwarza transkrypcję wiadomości głosowej"""
-        try:
-            logger.info(f"Przetwarzanie transkrypcji od {user_id}: {transcribed_text}")
-            
-            # Analizuj transkrypcję za pomocą AI
-            ai_response = await self.analyze_message_with_ai(user_id, transcribed_text)
-            
-            # Parsuj odpowiedź AI
-            action_type, data = self.parse_ai_response(ai_response)
-            
-            if action_type == "schedule_email":
-                # AI ma wszystkie dane - zaplanuj email
-                logger.info(f"🤖 AI zdecydował (GŁOS): PLANOWANIE EMAILA")
-                logger.info(f"   👤 Użytkownik: {user_id}")
-                logger.info(f"   📝 Temat: {data.get('subject', 'BRAK')}")
-                logger.info(f"   📅 Czas: {data.get('send_time', 'BRAK')}")
-                
-                result_message = await self.schedule_email_from_ai(user_id, data)
-                await update.message.reply_text(result_message)
-                
-            elif action_type == "request_attachment":
-                # AI potrzebuje załącznika
-                logger.info(f"🤖 AI zdecydował (GŁOS): PROŚBA O ZAŁĄCZNIK")
-                logger.info(f"   👤 Użytkownik: {user_id}")
-                logger.info(f"   📎 Info: {data.get('info', 'BRAK')}")
-                
-                self.email_planning_state[user_id] = data
-                await update.message.reply_text(f"📎 {data['info']}\n\nWyslij zalacznik jako plik.")
-                
-            else:
-                # Zwykła odpowiedź tekstowa
-                logger.info(f"🤖 AI zdecydował (GŁOS): ODPOWIEDŹ TEKSTOWA")
-                logger.info(f"   👤 Użytkownik: {user_id}")
-                logger.info(f"   💬 Odpowiedź: {ai_response[:100]}{'...' if len(ai_response) > 100 else ''}")
-                
-                await update.message.reply_text(ai_response)
-                
-        except Exception as e:
-            logger.error(f"Błąd przetwarzania transkrypcji: {e}")
-            await update.message.reply_text("❌ Błąd podczas przetwarzania transkrypcji.")
+            await msg.reply_text("❌ Błąd podczas przetwarzania wiadomości głosowej.")
     
     async def handle_document(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Obsługuje załączniki"""
+        msg = update.effective_message
+        if msg is None or update.effective_user is None:
+            return
+        
         user_id = update.effective_user.id
         
-        logger.info(f"📎 ZAŁĄCZNIK OTRZYMANY:")
-        logger.info(f"   👤 Użytkownik: {user_id}")
-        logger.info(f"   📄 Nazwa pliku: {update.message.document.file_name}")
-        logger.info(f"   📏 Rozmiar: {update.message.document.file_size} bajtów")
+        logger.info(f"📎 Załącznik otrzymany: użytkownik={user_id} plik={msg.document.file_name!r} "
+                    f"rozmiar={msg.document.file_size} B")
         
         if user_id not in self.email_planning_state:
             logger.warning(f"⚠️  Użytkownik {user_id} wysłał załącznik bez oczekiwania")
-            await update.message.reply_text("❌ Nie oczekuję żadnego załącznika. Najpierw opisz email, który chcesz zaplanować.")
+            await msg.reply_text("❌ Nie oczekuję żadnego załącznika. Najpierw opisz email, który chcesz zaplanować.")
             return
         
         try:
             # Pobierz plik
-            document = update.message.document
+            document = msg.document
             file = await context.bot.get_file(document.file_id)
             
             # Zapisz załącznik
-            attachment_filename = f"attachment_{user_id}_{datetime.now().timestamp()}_{document.file_name}"
+            attachment_filename = f"attachment_{user_id}_{int(time.time() * 1000)}_{document.file_name}"
             attachment_path = os.path.join("attachments", attachment_filename)
             
-            # Utwórz folder attachments jeśli nie istnieje
-            os.makedirs("attachments", exist_ok=True)
+            # Utwórz folder attachments jeśli nie istnieje (tylko przy pierwszym załączniku)
+            if not self._attachments_dir_created:
+                os.makedirs("attachments", exist_ok=True)
+                self._attachments_dir_created = True
             
             await file.download_to_drive(attachment_path)
             
-            # Pobierz dane emaila z pamięci
-            memory = self.get_user_memory(user_id)
-            last_assistant_message = None
-            for msg in reversed(memory["messages"]):
-                if msg["role"] == "assistant":
-                    last_assistant_message = msg["content"]
-                    break
+            # Pobierz dane emaila z ostatniej (już sparsowanej) odpowiedzi AI
+            action_type, email_data = self.email_planning_state[user_id].get("_parsed", (None, None))
             
-            if last_assistant_message and last_assistant_message.startswith("GOTOWE:"):
-                # Parsuj dane emaila
-                _, email_data = self.parse_ai_response(last_assistant_message)
-                
+            if action_type == "schedule_email":
                 # Zaplanuj email z załącznikiem
                 result_message = await self.schedule_email_from_ai(user_id, email_data, attachment_path)
-                await update.message.reply_text(result_message)
+                await msg.reply_text(result_message)
             else:
-                await update.message.reply_text("✅ Załącznik otrzymany. Teraz opisz szczegóły emaila.")
+                await msg.reply_text("✅ Załącznik otrzymany. Teraz opisz szczegóły emaila.")
             
         except Exception as e:
             logger.error(f"Błąd przetwarzania załącznika: {e}")
-            await update.message.reply_text("❌ Błąd podczas przetwarzania załącznika.")
+            await msg.reply_text("❌ Błąd podczas przetwarzania załącznika.")
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Obsługuje komendę /start"""
+        msg = update.effective_message
+        if msg is None or update.effective_user is None:
+            return
+        
         welcome_message = """🤖 **Bot do planowania emaili**
 
 Cześć! Jestem botem AI, który pomoże Ci zaplanować wysyłkę emaili.
@@ -680,10 +992,14 @@ Cześć! Jestem botem AI, który pomoże Ci zaplanować wysyłkę emaili.
 
 Zacznij od opisania emaila, który chcesz zaplanować! 📧"""
         
-        await update.message.reply_text(welcome_message, parse_mode='Markdown')
+        await msg.reply_text(welcome_message, parse_mode='Markdown')
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Obsługuje komendę /help"""
+        msg = update.effective_message
+        if msg is None or update.effective_user is None:
+            return
+        
         help_message = """📚 **Pomoc - Bot do planowania emaili**
 
 **Funkcje:**
@@ -711,70 +1027,136 @@ Zacznij od opisania emaila, który chcesz zaplanować! 📧"""
 **Wsparcie:**
 Jeśli masz problemy, napisz wiadomość opisującą co chcesz zrobić, a bot pomoże! 🤖"""
         
-        await update.message.reply_text(help_message, parse_mode='Markdown')
+        await msg.reply_text(help_message, parse_mode='Markdown')
     
     async def status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Obsługuje komendę /status"""
-        status_message = f"""📊 **Status bota**
-
-✅ Bot aktywny
-✅ Email scheduler: {self.config.get('default_recipient')}
-✅ OpenAI API: {'Połączone' if self.config.get('openai_api_key') else 'Nie skonfigurowane'}
-✅ Aktywne konwersacje: {len(self.conversation_memory)}
-
-**Ostatnie aktywności:**
-Sprawdź logi w pliku `telegram_bot.log`"""
+        msg = update.effective_message
+        if msg is None or update.effective_user is None:
+            return
         
-        await update.message.reply_text(status_message, parse_mode='Markdown')
+        status_message = _render_status(self._default_recipient, self._has_openai_str, self._active_convs)
+        
+        await msg.reply_text(status_message)
     
     async def set_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Obsługuje komendę /set - ustawia email użytkownika"""
+        msg = update.effective_message
+        if msg is None or update.effective_user is None:
+            return
+        
         user_id = update.effective_user.id
         
         # Sprawdź czy podano email jako argument
-        if context.args and len(context.args) > 0:
-            email = context.args[0].strip()
+        if context.args:
+            # PTB dzieli argumenty po białych znakach - nie wymagają strip()
+            email = context.args[0]
             
             # Prosta walidacja emaila
-            if '@' in email and '.' in email.split('@')[1]:
+            if _EMAIL_RE.match(email):
                 self.set_user_email(user_id, email)
-                await update.message.reply_text(
-                    f"✅ **Email ustawiony!**\n\n"
-                    f"Twój adres email to: `{email}`\n\n"
-                    f"Teraz wszystkie zaplanowane emaile będą wysyłane na ten adres! 📧",
-                    parse_mode='Markdown'
-                )
+                await msg.reply_text(_SET_OK_TEMPLATE.format(email=email), parse_mode='Markdown')
             else:
-                await update.message.reply_text(
-                    "❌ **Nieprawidłowy format emaila!**\n\n"
-                    "Użyj: `/set twoj@email.com`\n"
-                    "Przykład: `/set jan.kowalski@gmail.com`",
-                    parse_mode='Markdown'
-                )
+                await msg.reply_text(_SET_BAD, parse_mode='Markdown')
         else:
             # Pokaż aktualny email użytkownika
             current_email = self.get_user_email(user_id)
-            await update.message.reply_text(
-                f"📧 **Twój aktualny email:** `{current_email}`\n\n"
-                f"**Aby zmienić email, użyj:**\n"
-                f"`/set nowy@email.com`\n\n"
-                f"**Przykład:**\n"
-                f"`/set jan.kowalski@gmail.com`",
-                parse_mode='Markdown'
-            )
+            await msg.reply_text(_SET_SHOW_TEMPLATE.format(email=current_email), parse_mode='Markdown')
     
     def setup_handlers(self, application: Application):
         """Konfiguruje handlery bota"""
-        # Komendy
-        application.add_handler(CommandHandler("start", self.start_command))
-        application.add_handler(CommandHandler("help", self.help_command))
-        application.add_handler(CommandHandler("status", self.status_command))
-        application.add_handler(CommandHandler("set", self.set_command))
+        application.add_handlers([
+            # Komendy
+            CommandHandler("start", self.start_command),
+            CommandHandler("help", self.help_command),
+            CommandHandler("status", self.status_command),
+            CommandHandler("set", self.set_command),
+            
+            # Wiadomości
+            MessageHandler(_TEXT_FILTER, self.handle_text_message),
+            MessageHandler(filters.VOICE, self.handle_voice_message),
+            MessageHandler(filters.Document.ALL, self.handle_document)
+        ])
+        
+        # Okresowe czyszczenie nieaktywnych konwersacji
+        if application.job_queue is None:
+            logger.warning("⚠️ JobQueue niedostępna (pip install \"python-telegram-bot[job-queue]\") - "
+                           "nieaktywne konwersacje będą usuwane tylko przez limit LRU")
+        else:
+            application.job_queue.run_repeating(
+                self._prune_conversations,
+                interval=CONVERSATION_PRUNE_INTERVAL,
+                first=CONVERSATION_PRUNE_INTERVAL
+            )
+    
+    async def _run(self):
+        """Uruchamia bota w bieżącej pętli zdarzeń i działa do Ctrl+C albo SIGTERM/SIGABRT"""
+        # Utwórz aplikację - klienty HTTP/2 z pulą połączeń keep-alive do Bot API,
+        # współdzielone przez wszystkie pobrania plików i odpowiedzi (osobny dla getUpdates,
+        # żeby długie odpytywanie nie zajmowało połączeń odpowiedzi)
+        request = HTTPXRequest(
+            connection_pool_size=256,
+            http_version="2",
+            connect_timeout=10,
+            read_timeout=30,
+            write_timeout=30,
+            pool_timeout=30
+        )
+        get_updates_request = HTTPXRequest(
+            connection_pool_size=64,
+            http_version="2",
+            connect_timeout=10,
+            read_timeout=30,
+            write_timeout=30,
+            pool_timeout=30
+        )
+        application = (
+            Application.builder()
+            .token(self.config["telegram_token"])
+            .request(request)
+            .get_updates_request(get_updates_request)
+            .build()
+        )
         
-        # Wiadomości
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_text_message))
-        application.add_handler(MessageHandler(filters.VOICE, self.handle_voice_message))
-        application.add_handler(MessageHandler(filters.Document.ALL, self.handle_document))
+        # Skonfiguruj handlery
+        self.setup_handlers(application)
+        
+        logger.info("Bot uruchamiany...")
+        
+        # initialize/shutdown przez async with; long polling (serwer trzyma getUpdates
+        # do 30 s) i tylko aktualizacje z _ALLOWED_UPDATES
+        async with application:
+            await application.start()
+            await application.updater.start_polling(timeout=30, poll_interval=0.0, allowed_updates=_ALLOWED_UPDATES)
+            writer_task = asyncio.create_task(self._user_emails_writer())
+            # asyncio.run obsługuje tylko Ctrl+C - SIGTERM/SIGABRT (systemd, docker stop)
+            # kończą działanie tą samą ścieżką co run_polling w PTB
+            stop_event = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGTERM, signal.SIGABRT):
+                try:
+                    loop.add_signal_handler(sig, stop_event.set)
+                except (NotImplementedError, AttributeError):
+                    # Windows - brak add_signal_handler
+                    pass
+            try:
+                # Pętla jest wspólna - inne zadania (scheduler, OpenAI) działają obok
+                await stop_event.wait()
+            finally:
+                await application.updater.stop()
+                # Wątek schedulera (executor asyncio, nie daemon) musi się zakończyć -
+                # inaczej asyncio.run czeka na niego w shutdown_default_executor
+                await self.stop_scheduler_background()
+                await application.stop()
+                # Zapisz zmiany z ostatniej sekundy przed wyjściem
+                # Poczekaj, aż writer faktycznie się zakończy - inaczej jego zapis
+                # mógłby nałożyć się na końcowy flush
+                writer_task.cancel()
+                try:
+                    await writer_task
+                except asyncio.CancelledError:
+                    pass
+                await self._flush_user_emails()
     
     def run_bot(self):
         """Uruchamia bota"""
@@ -782,17 +1164,14 @@ Sprawdź logi w pliku `telegram_bot.log`"""
             logger.error("Brak tokenu Telegram w konfiguracji!")
             return
         
-        # Utwórz aplikację
-        application = Application.builder().token(self.config["telegram_token"]).build()
+        # Pętla zdarzeń uvloop (jeśli dostępna) - asyncio.run utworzy już pętlę uvloop
+        if uvloop is not None:
+            uvloop.install()
         
-        # Skonfiguruj handlery
-        self.setup_handlers(application)
-        
-        logger.info("Bot uruchamiany...")
-        
-        # Uruchom bota
-        application.run_polling()
-
+        try:
+            asyncio.run(self._run())
+        except KeyboardInterrupt:
+            logger.info("Bot zatrzymany")
 
 def main():
     """Funkcja główna"""